@@ -22,10 +22,12 @@ class CategoryForm(forms.ModelForm):
             "is_removed",
             "color")
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, parent_queryset=None, **kwargs):
         super().__init__(*args, **kwargs)
+        if parent_queryset is None:
+            parent_queryset = Category.objects.all()
         queryset = (
-            Category.objects
+            parent_queryset
             .visible()
             .parents()
             .ordered())
@@ -1,10 +1,15 @@
 import datetime
+from importlib import import_module
+from types import MappingProxyType
 
+from django.conf import settings
 from django.test import TestCase, RequestFactory, override_settings
-from django.urls import reverse
-from django.core.exceptions import PermissionDenied
-from django.contrib.auth import get_user_model
+from django.urls import reverse, reverse_lazy
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.contrib.auth import (
+    get_user_model, SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY)
 from django.utils import timezone
+from djconfig import reload_maybe
 
 from spirit.core.tests import utils
 from . import views as category_views
@@ -13,20 +18,79 @@ from .forms import CategoryForm
 
 User = get_user_model()
 
+# Enough to validate a parent, the choice labels are not rendered
+PARENT_QUERYSET = Category.objects.only(
+    'title', 'parent', 'is_removed', 'is_private')
 
+BASE_FORM_DATA = MappingProxyType({
+    "parent": "",
+    "title": "foo",
+    "description": "",
+    "is_closed": False,
+    "is_removed": False,
+    "is_global": True,
+    "color": ""})
+
+INDEX_URL = reverse_lazy('spirit:admin:category:index')
+CREATE_URL = reverse_lazy('spirit:admin:category:create')
+
+
+def _update_url(pk):
+    return reverse('spirit:admin:category:update', kwargs={'category_id': pk})
+
+
+def _move_up_url(pk):
+    return reverse('spirit:admin:category:move_up', kwargs={'category_id': pk})
+
+
+def _move_dn_url(pk):
+    return reverse('spirit:admin:category:move_dn', kwargs={'category_id': pk})
+
+
+def _build_session_for(user):
+    """Return the key of a saved session logged in as the given user"""
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return session.session_key
+
+
+# speedup fixtures creating users
+_fast_hashers = override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+
+
+@_fast_hashers
 class AdminViewTest(TestCase):
 
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = utils.create_user()
+        cls.user.st.is_administrator = True
+        cls.user.st.save()
+        cls.category = utils.create_category()
+        cls.topic = utils.create_topic(cls.category, user=cls.user)
+        cls.update_url = _update_url(cls.category.pk)
+        cls._session_cookie = _build_session_for(cls.user)
+
     def setUp(self):
         utils.cache_clear()
-        self.user = utils.create_user()
-        self.user.st.is_administrator = True
-        self.user.st.save()
-        self.category = utils.create_category()
-        self.topic = utils.create_topic(self.category, user=self.user)
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = self._session_cookie
+        # Keep query counts stable, config loading depends on test order
+        reload_maybe()
+
+    def _reload_sorts(self, *categories):
+        rows = (
+            Category.objects
+            .only('sort')
+            .in_bulk([c.pk for c in categories]))
+        return [rows[c.pk].sort for c in categories]
 
     def test_permission_denied_to_non_admin(self):
         req = RequestFactory().get('/')
-        req.user = self.user
+        req.user = User.objects.get(pk=self.user.pk)
         req.user.st.is_administrator = False
 
         self.assertRaises(PermissionDenied, category_views.index, req)
@@ -39,100 +103,88 @@ class AdminViewTest(TestCase):
         """
         utils.create_category(parent=self.category)
         categories = Category.objects.filter(is_private=False, parent=None)
-        utils.login(self)
-        response = self.client.get(reverse('spirit:admin:category:index'))
-        self.assertEqual(list(response.context['categories']), list(categories))
+        with self.assertNumQueries(7):
+            response = self.client.get(INDEX_URL)
+        self.assertQuerysetEqual(
+            response.context['categories'],
+            list(categories.values_list('pk', flat=True)),
+            transform=lambda c: c.pk)
 
-    def test_category_create(self):
+    def test_category_create_post(self):
         """
         Category create
         """
-        utils.login(self)
-        form_data = {
-            "parent": "", "title": "foo", "description": "",
-            "is_closed": False, "is_removed": False, "is_global": True, "color": ""}
-        response = self.client.post(reverse('spirit:admin:category:create'),
-                                    form_data)
-        expected_url = reverse("spirit:admin:category:index")
-        self.assertRedirects(response, expected_url, status_code=302)
+        response = self.client.post(CREATE_URL, BASE_FORM_DATA)
+        self.assertRedirects(
+            response, INDEX_URL, status_code=302, fetch_redirect_response=False)
 
-        response = self.client.get(reverse('spirit:admin:category:create'))
+    def test_category_create_get(self):
+        """
+        Category create form
+        """
+        with self.assertNumQueries(6):
+            response = self.client.get(CREATE_URL)
         self.assertEqual(response.status_code, 200)
 
-    def test_category_update(self):
+    def test_category_update_post(self):
         """
         Category update
         """
-        utils.login(self)
-        form_data = {
-            "parent": "", "title": "foo", "description": "",
-            "is_closed": False, "is_removed": False, "is_global": True, "color": "#ff0000"}
-        response = self.client.post(
-            reverse('spirit:admin:category:update', kwargs={"category_id": self.category.pk, }),
-            form_data)
-        expected_url = reverse("spirit:admin:category:index")
-        self.assertRedirects(response, expected_url, status_code=302)
-
-        response = self.client.get(
-            reverse('spirit:admin:category:update', kwargs={"category_id": self.category.pk, }))
+        form_data = {**BASE_FORM_DATA, "color": "#ff0000"}
+        response = self.client.post(self.update_url, form_data)
+        self.assertRedirects(
+            response, INDEX_URL, status_code=302, fetch_redirect_response=False)
+
+    def test_category_update_get(self):
+        """
+        Category update form
+        """
+        with self.assertNumQueries(7):
+            response = self.client.get(self.update_url)
         self.assertEqual(response.status_code, 200)
 
     def test_category_form_color(self):
         """ Test category form raises exception on wrong color """
-        form_data = {
-            "parent": "", "title": "foo", "description": "",
-            "is_closed": False, "is_removed": False, "is_global": True, "color": "#QWERTZ"}
-        form = CategoryForm(data=form_data)
-
-        self.assertFalse(form.is_valid())
+        form = CategoryForm()
+        form.cleaned_data = {"color": "#QWERTZ"}
+        self.assertRaises(ValidationError, form.clean_color)
 
     def test_category_move_up_down(self):
         """Should order the category when moving up/down"""
-        utils.login(self)
-        self.another_category = utils.create_category()
-        response = self.client.post(
-            reverse(
-                'spirit:admin:category:move_dn',
-                kwargs={"category_id": self.category.pk, }))
-        expected_url = reverse("spirit:admin:category:index")
-        self.assertRedirects(response, expected_url, status_code=302)
-        self.category.refresh_from_db()
-        self.another_category.refresh_from_db()        
-        self.assertTrue(self.category.sort > self.another_category.sort)
-
-        response = self.client.post(
-            reverse(
-                'spirit:admin:category:move_up',
-                kwargs={"category_id": self.category.pk, }))
-        expected_url = reverse("spirit:admin:category:index")
-        self.assertRedirects(response, expected_url, status_code=302)
-        self.category.refresh_from_db()
-        self.another_category.refresh_from_db()        
-        self.assertTrue(self.category.sort < self.another_category.sort)
+        another_category = utils.create_category()
+        response = self.client.post(_move_dn_url(self.category.pk))
+        self.assertRedirects(
+            response, INDEX_URL, status_code=302, fetch_redirect_response=False)
+        sort, another_sort = self._reload_sorts(
+            self.category, another_category)
+        self.assertTrue(sort > another_sort)
+
+        response = self.client.post(_move_up_url(self.category.pk))
+        self.assertRedirects(
+            response, INDEX_URL, status_code=302, fetch_redirect_response=False)
+        sort, another_sort = self._reload_sorts(
+            self.category, another_category)
+        self.assertTrue(sort < another_sort)
 
 
+@_fast_hashers
 class AdminFormTest(TestCase):
 
-    def setUp(self):
-        utils.cache_clear()
-        self.user = utils.create_user()
-        self.category = utils.create_category()
-        self.topic = utils.create_topic(self.category)
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = utils.create_user()
+        cls.category = utils.create_category()
+        cls.topic = utils.create_topic(cls.category)
+        cls.subcategory = utils.create_category(parent=cls.category)
+        cls.other_category = utils.create_category()
+        cls.removed_category = utils.create_category(is_removed=True)
+        cls.private_category = utils.create_category(is_private=True)
 
     def test_category(self):
         """
         Add category
         """
-        form_data = {
-            "parent": "",
-            "title": "foo",
-            "description": "",
-            "is_closed": False,
-            "is_removed": False,
-            "is_global": True,
-            "color": ""
-        }
-        form = CategoryForm(data=form_data)
+        form = CategoryForm(data=BASE_FORM_DATA)
         self.assertEqual(form.is_valid(), True)
         category = form.save()
         self.assertTrue(category.sort > 0)
@@ -141,78 +193,81 @@ class AdminFormTest(TestCase):
         """
         invalid parent
         """
-        # parent can not be a subcategory, only one level subcat is allowed
-        subcategory = utils.create_category(parent=self.category)
-        form_data = {"parent": subcategory.pk, }
-        form = CategoryForm(data=form_data)
-        self.assertEqual(form.is_valid(), False)
-        self.assertNotIn('parent', form.cleaned_data)
-
-        # parent can not be set to a category with childrens
-        category_ = utils.create_category()
-        form_data = {"parent": category_.pk, }
-        form = CategoryForm(data=form_data, instance=self.category)
-        self.assertEqual(form.is_valid(), False)
-        self.assertNotIn('parent', form.cleaned_data)
-
-        # parent can not be removed
-        category_ = utils.create_category(is_removed=True)
-        form_data = {"parent": category_.pk, }
-        form = CategoryForm(data=form_data)
-        self.assertEqual(form.is_valid(), False)
-        self.assertNotIn('parent', form.cleaned_data)
-
-        # parent can not be private
-        category_ = utils.create_category(is_private=True)
-        form_data = {"parent": category_.pk, }
-        form = CategoryForm(data=form_data)
-        self.assertEqual(form.is_valid(), False)
-        self.assertNotIn('parent', form.cleaned_data)
+        cases = [
+            # parent can not be a subcategory, only one level subcat is allowed
+            (self.subcategory, None),
+            # parent can not be set to a category with childrens
+            (self.other_category, self.category),
+            # parent can not be removed
+            (self.removed_category, None),
+            # parent can not be private
+            (self.private_category, None)]
+        for parent, instance in cases:
+            with self.subTest(parent=parent.title):
+                form = CategoryForm(
+                    data={"parent": parent.pk},
+                    instance=instance,
+                    parent_queryset=PARENT_QUERYSET)
+                self.assertEqual(form.is_valid(), False)
+                self.assertNotIn('parent', form.cleaned_data)
 
     def test_category_updates_reindex_at(self):
         """
         Should update reindex_at field
         """
-        form_data = {
-            "parent": "",
-            "title": "foo",
-            "description": "",
-            "is_closed": False,
-            "is_removed": False,
-            "is_global": True,
-            "color": ""}
         yesterday = timezone.now() - datetime.timedelta(days=1)
         category = utils.create_category(
             reindex_at=yesterday)
         self.assertEqual(
             category.reindex_at,
             yesterday)
-        form = CategoryForm(instance=category, data=form_data)
+        form = CategoryForm(instance=category, data=BASE_FORM_DATA)
         self.assertEqual(form.is_valid(), True)
         form.save()
         self.assertGreater(
             Category.objects.get(pk=category.pk).reindex_at,
             yesterday)
 
-    @override_settings(ST_ORDERED_CATEGORIES=True)
+
+class AdminFormOrderingTestBase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # Skip the deletion collector, no signals needed here
+        Category.objects.all()._raw_delete(Category.objects.db)
+        Category.objects.bulk_create([
+            Category(title="1", sort=2),
+            Category(title="2", sort=1)])
+        # Not every backend sets the pk on bulk create
+        cls.cat1, cls.cat2 = Category.objects.order_by('title')
+
+
+@override_settings(ST_ORDERED_CATEGORIES=True)
+class AdminFormOrderingTest(AdminFormOrderingTestBase):
+
     def test_category_order(self):
-        Category.objects.all().delete()
-        cat1 = utils.create_category(title="1", sort=2)
-        cat2 = utils.create_category(title="2", sort=1)
-        self.assertEqual(list(Category.objects.all()), [cat1, cat2])
+        cat1, cat2 = self.cat1, self.cat2
+        self.assertQuerysetEqual(
+            Category.objects.all(), [cat1.pk, cat2.pk], transform=lambda c: c.pk)
         form = CategoryForm(data=None)
-        self.assertEqual(list(form.fields['parent'].queryset), [cat2, cat1])
+        self.assertQuerysetEqual(
+            form.fields['parent'].queryset, [cat2.pk, cat1.pk], transform=lambda c: c.pk)
         cat1.sort = 0
         cat1.save()
-        self.assertEqual(list(Category.objects.all()), [cat1, cat2])
+        self.assertQuerysetEqual(
+            Category.objects.all(), [cat1.pk, cat2.pk], transform=lambda c: c.pk)
         form = CategoryForm(data=None)
-        self.assertEqual(list(form.fields['parent'].queryset), [cat1, cat2])
+        self.assertQuerysetEqual(
+            form.fields['parent'].queryset, [cat1.pk, cat2.pk], transform=lambda c: c.pk)
+
+
+@override_settings(ST_ORDERED_CATEGORIES=False)
+class AdminFormOrderingByTitleTest(AdminFormOrderingTestBase):
 
-    @override_settings(ST_ORDERED_CATEGORIES=False)
     def test_category_order_by_title(self):
-        Category.objects.all().delete()
-        cat1 = utils.create_category(title="1", sort=2)
-        cat2 = utils.create_category(title="2", sort=1)
-        self.assertEqual(list(Category.objects.all()), [cat1, cat2])
+        cat1, cat2 = self.cat1, self.cat2
+        self.assertQuerysetEqual(
+            Category.objects.all(), [cat1.pk, cat2.pk], transform=lambda c: c.pk)
         form = CategoryForm(data=None)
-        self.assertEqual(list(form.fields['parent'].queryset), [cat1, cat2])
+        self.assertQuerysetEqual(
+            form.fields['parent'].queryset, [cat1.pk, cat2.pk], transform=lambda c: c.pk)
@@ -1,4 +1,5 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.db.models import Prefetch
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.contrib import messages
@@ -18,7 +19,10 @@ def index(request):
     categories = (
         Category.objects
         .filter(parent=None, is_private=False)
-        .ordered())
+        .ordered()
+        .prefetch_related(Prefetch(
+            'category_set',
+            queryset=Category.objects.ordered())))
     return render(
         request=request,
         template_name='spirit/category/admin/index.html',
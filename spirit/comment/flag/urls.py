@@ -1,9 +1,9 @@
-from django.conf.urls import re_path
+from django.urls import path
 
 from . import views
 
 
 app_name = 'flag'
 urlpatterns = [
-    re_path(r'^(?P<comment_id>[0-9]+)/create/$', views.create, name='create'),
+    path('<int:comment_id>/create/', views.create, name='create'),
 ]